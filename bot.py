@@ -6,10 +6,24 @@ load_dotenv()
 import discord
 from discord.ext import commands, tasks
 import asyncio
+import bisect
 import json
 import random
+
+try:
+    import orjson  # optional: much faster encode/decode for the data files
+except ImportError:
+    orjson = None
+
+try:
+    import numpy as np  # optional: vectorized portfolio valuation
+except ImportError:
+    np = None
 import datetime
+import time
+import collections
 import aiohttp
+import hashlib
 import logging
 from typing import Dict, List, Optional
 
@@ -22,6 +36,8 @@ DEFAULT_STARTING_BALANCE = 10000.0
 STOCKS_DATA_FILE = 'stocks_data.json'
 USERS_DATA_FILE = 'users_data.json'
 PRICE_UPDATE_INTERVAL = 60  # seconds
+SAVE_FLUSH_INTERVAL = 30  # seconds between dirty-data flushes to disk
+HISTORY_LIMIT = 24  # price points kept per stock
 ALPHA_VANTAGE_API_KEY = 'YOUR_ALPHA_VANTAGE_API_KEY'  # Replace with your actual API key
 DEFAULT_STOCK_SYMBOLS = ['AAPL', 'MSFT', 'GOOGL', 'AMZN', 'META', 'TSLA', 'NVDA', 'JPM', 'V', 'WMT']
 
@@ -35,15 +51,53 @@ bot = commands.Bot(command_prefix='$', intents=intents)
 users_data = {}
 stocks_data = {}
 
+# Shared HTTP session (created lazily, reused for every Alpha Vantage request
+# so the TLS handshake and TCP connect only happen once per host)
+http_session: Optional[aiohttp.ClientSession] = None
+
+def get_http_session() -> aiohttp.ClientSession:
+    global http_session
+    if http_session is None or http_session.closed:
+        # Sized for the predictable polling loop: a handful of pooled
+        # connections, long-lived DNS cache and keep-alive, compressed bodies
+        http_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=10,
+                limit_per_host=5,
+                ttl_dns_cache=600,
+                keepalive_timeout=60
+            ),
+            timeout=aiohttp.ClientTimeout(total=10),
+            headers={"Accept-Encoding": "gzip"}
+        )
+    return http_session
+
+async def close_http_session():
+    global http_session
+    if http_session is not None and not http_session.closed:
+        await http_session.close()
+    http_session = None
+
 # Helper functions for data management
+def _json_loads(raw: bytes):
+    return orjson.loads(raw) if orjson is not None else json.loads(raw)
+
+def _json_dumps(obj) -> bytes:
+    # default=list converts the history deques back into plain JSON arrays
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2, default=list)
+    return json.dumps(obj, indent=4, default=list).encode()
+
 def load_data():
     global users_data, stocks_data
     
     # Load users data
     try:
         if os.path.exists(USERS_DATA_FILE):
-            with open(USERS_DATA_FILE, 'r') as f:
-                users_data = json.load(f)
+            with open(USERS_DATA_FILE, 'rb') as f:
+                # Discord IDs are ints; keep them that way in memory and only
+                # stringify at the JSON boundary
+                users_data = {int(k): v for k, v in _json_loads(f.read()).items()}
     except Exception as e:
         logger.error(f"Error loading users data: {e}")
         users_data = {}
@@ -51,134 +105,363 @@ def load_data():
     # Load stocks data
     try:
         if os.path.exists(STOCKS_DATA_FILE):
-            with open(STOCKS_DATA_FILE, 'r') as f:
-                stocks_data = json.load(f)
+            with open(STOCKS_DATA_FILE, 'rb') as f:
+                stocks_data = _json_loads(f.read())
     except Exception as e:
         logger.error(f"Error loading stocks data: {e}")
         stocks_data = {}
-        
-def save_data():
-    # Save users data
-    with open(USERS_DATA_FILE, 'w') as f:
-        json.dump(users_data, f, indent=4)
-    
-    # Save stocks data
-    with open(STOCKS_DATA_FILE, 'w') as f:
-        json.dump(stocks_data, f, indent=4)
+
+    _migrate_portfolio_entries()
+
+def _migrate_portfolio_entries():
+    """Upgrade legacy portfolios where entries were bare share counts.
+
+    New entries are {"shares": n, "cost_basis": c} dicts kept up to date by
+    buy/sell, so the cost basis never has to be recomputed from the full
+    transaction history. The one-time migration rebuilds it from the old
+    transactions here.
+    """
+    for user in users_data.values():
+        portfolio = user.get("portfolio", {})
+        for symbol, entry in portfolio.items():
+            if isinstance(entry, dict):
+                continue
+            cost_basis = 0.0
+            for transaction in user.get("transactions", []):
+                if transaction["symbol"] != symbol:
+                    continue
+                if transaction["type"] == "buy":
+                    cost_basis += transaction["total"]
+                elif transaction["type"] == "sell":
+                    cost_basis -= transaction["total"]
+            portfolio[symbol] = {"shares": entry, "cost_basis": cost_basis}
+            mark_users_dirty()
+
+# Per-user transaction history kept verbatim; older trades fold into a summary
+# so the stored list (and save_data's serialize cost) stops growing
+MAX_TRANSACTIONS = 100
+
+def _trim_transactions(user: dict):
+    """Roll transactions beyond the cap into the user's running summary"""
+    transactions = user["transactions"]
+    while len(transactions) > MAX_TRANSACTIONS:
+        oldest = transactions.pop(0)
+        summary = user.setdefault("summary", {"count": 0, "total_bought": 0.0, "total_sold": 0.0})
+        summary["count"] += 1
+        if oldest["type"] == "buy":
+            summary["total_bought"] += oldest["total"]
+        else:
+            summary["total_sold"] += oldest["total"]
+
+# Dirty flags: commands mark data as changed instead of rewriting the JSON
+# files on every call; the flush_data loop batches the actual disk writes
+_users_dirty = False
+_stocks_dirty = False
+
+def mark_users_dirty():
+    global _users_dirty
+    _users_dirty = True
+
+def mark_stocks_dirty():
+    global _stocks_dirty
+    _stocks_dirty = True
+
+def _atomic_write(path: str, payload: bytes):
+    # Write to a sibling temp file and rename over the target; os.replace is
+    # atomic on POSIX, so a crash mid-write can never corrupt the data file
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def _save_users_sync():
+    # Encode to a single bytes object first so the write is one big syscall
+    # instead of the many small ones json.dump would issue
+    _atomic_write(USERS_DATA_FILE, _json_dumps({str(k): v for k, v in users_data.items()}))
+
+def _save_stocks_sync():
+    _atomic_write(STOCKS_DATA_FILE, _json_dumps(stocks_data))
+
+# Serializes writers; the encode and file write run in a worker thread so the
+# event loop keeps handling commands during a save
+_save_lock = asyncio.Lock()
+
+async def save_users_data():
+    async with _save_lock:
+        await asyncio.to_thread(_save_users_sync)
+
+async def save_stocks_data():
+    async with _save_lock:
+        await asyncio.to_thread(_save_stocks_sync)
+
+async def save_data():
+    """Force-write both data files and clear the dirty flags"""
+    global _users_dirty, _stocks_dirty
+    _users_dirty = False
+    _stocks_dirty = False
+    async with _save_lock:
+        await asyncio.to_thread(_save_users_sync)
+        await asyncio.to_thread(_save_stocks_sync)
+
+@tasks.loop(seconds=SAVE_FLUSH_INTERVAL)
+async def flush_data():
+    """Periodically write whichever data files have changed"""
+    global _users_dirty, _stocks_dirty
+    if _users_dirty:
+        _users_dirty = False
+        await save_users_data()
+    if _stocks_dirty:
+        _stocks_dirty = False
+        await save_stocks_data()
+
+# Quote cache: back-to-back $price calls for the same symbol within the TTL
+# reuse the last response instead of spending another API call
+PRICE_CACHE_TTL = 30  # seconds
+_price_cache = {}  # symbol -> (fetched_at, price)
+
+# Company overviews change at most daily, so $info responses are cached for
+# a day with LRU eviction to bound memory
+INFO_CACHE_TTL = 86400  # seconds
+INFO_CACHE_SIZE = 256
+_info_cache = collections.OrderedDict()  # symbol -> (fetched_at, data)
+
+# Once Alpha Vantage reports its quota exhausted, skip further requests until
+# this deadline instead of burning the whole cycle on doomed calls
+RATE_LIMIT_BACKOFF = 60  # seconds
+_rate_limited_until = 0.0
 
 async def fetch_stock_price(symbol: str) -> Optional[float]:
     """Fetch real stock price from Alpha Vantage API"""
+    global _rate_limited_until
+
+    cached = _price_cache.get(symbol)
+    if cached and time.time() - cached[0] < PRICE_CACHE_TTL:
+        return cached[1]
+
+    if time.time() < _rate_limited_until:
+        return None
+
     try:
         url = f"https://www.alphavantage.co/query?function=GLOBAL_QUOTE&symbol={symbol}&apikey={ALPHA_VANTAGE_API_KEY}"
-        
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    
-                    # Check if we got valid data
-                    if "Global Quote" in data and "05. price" in data["Global Quote"]:
-                        price = float(data["Global Quote"]["05. price"])
-                        logger.info(f"Successfully fetched price for {symbol}: ${price}")
-                        return price
-                    else:
-                        # Check if we hit API limit
-                        if "Note" in data:
-                            logger.warning(f"Alpha Vantage API limit reached: {data['Note']}")
-                        else:
-                            logger.warning(f"No price data for {symbol} in response: {data}")
-                        return None
+
+        async with get_http_session().get(url) as response:
+            if response.status == 200:
+                data = await response.json(loads=_json_loads)
+
+                # Check if we got valid data
+                if "Global Quote" in data and "05. price" in data["Global Quote"]:
+                    price = float(data["Global Quote"]["05. price"])
+                    logger.info(f"Successfully fetched price for {symbol}: ${price}")
+                    _price_cache[symbol] = (time.time(), price)
+                    _rate_limited_until = 0.0
+                    return price
                 else:
-                    logger.error(f"API request failed with status {response.status}")
+                    # Check if we hit API limit
+                    if "Note" in data:
+                        logger.warning(f"Alpha Vantage API limit reached: {data['Note']}")
+                        _rate_limited_until = time.time() + RATE_LIMIT_BACKOFF
+                    else:
+                        logger.warning(f"No price data for {symbol} in response: {data}")
                     return None
+            else:
+                logger.error(f"API request failed with status {response.status}")
+                return None
     except Exception as e:
         logger.error(f"Error fetching stock price for {symbol}: {e}")
         return None
 
+def _stable_hash(symbol: str) -> int:
+    """Deterministic hash of a symbol, stable across process restarts.
+
+    The built-in hash() is randomized per process (PYTHONHASHSEED), which
+    made mock base prices change on every bot restart.
+    """
+    return int.from_bytes(hashlib.blake2b(symbol.encode(), digest_size=4).digest(), 'little')
+
 # For testing/development when you don't want to use Alpha Vantage or hit API limits
 def generate_mock_price(symbol: str) -> float:
     """Generate a mock price for testing purposes"""
-    base_price = hash(symbol) % 1000  # deterministic base price
-    if symbol not in stocks_data:
-        stocks_data[symbol] = {"current_price": base_price}
-        return base_price
-    
+    current_price = stocks_data.get(symbol, {}).get("current_price")
+    if current_price is None:
+        return _stable_hash(symbol) % 1000  # deterministic base price
+
     # Fluctuate price by small percentage
-    current_price = stocks_data[symbol]["current_price"]
     change_percent = (random.random() - 0.5) * 0.05  # -2.5% to +2.5%
     new_price = current_price * (1 + change_percent)
     return round(new_price, 2)
 
 async def fetch_stock_info(symbol: str) -> dict:
     """Fetch stock information from Alpha Vantage"""
+    cached = _info_cache.get(symbol)
+    if cached and time.time() - cached[0] < INFO_CACHE_TTL:
+        _info_cache.move_to_end(symbol)
+        return cached[1]
+
     try:
         url = f"https://www.alphavantage.co/query?function=OVERVIEW&symbol={symbol}&apikey={ALPHA_VANTAGE_API_KEY}"
-        
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    
-                    # Check if we got valid data
-                    if "Symbol" in data:
-                        return data
-                    else:
-                        logger.warning(f"No company overview data for {symbol}")
-                        return {}
+
+        async with get_http_session().get(url) as response:
+            if response.status == 200:
+                data = await response.json(loads=_json_loads)
+
+                # Check if we got valid data
+                if "Symbol" in data:
+                    _info_cache[symbol] = (time.time(), data)
+                    _info_cache.move_to_end(symbol)
+                    if len(_info_cache) > INFO_CACHE_SIZE:
+                        _info_cache.popitem(last=False)
+                    return data
                 else:
-                    logger.error(f"API request failed with status {response.status}")
+                    logger.warning(f"No company overview data for {symbol}")
                     return {}
+            else:
+                logger.error(f"API request failed with status {response.status}")
+                return {}
     except Exception as e:
         logger.error(f"Error fetching stock info for {symbol}: {e}")
         return {}
 
+# Structure-of-arrays view of current prices, rebuilt after each price tick:
+# a symbol -> row index map plus a parallel price vector, so valuing a
+# portfolio is one dot product instead of a Python loop per holding
+_symbol_index = {}
+_price_vector = None
+
+def rebuild_price_vector():
+    global _symbol_index, _price_vector
+    if np is None:
+        return
+    _symbol_index = {symbol: i for i, symbol in enumerate(stocks_data)}
+    _price_vector = np.array(
+        [stocks_data[symbol].get("current_price", 0) for symbol in _symbol_index],
+        dtype=np.float64
+    )
+
+def portfolio_value(portfolio: dict) -> float:
+    """Value a portfolio at current prices"""
+    if _price_vector is not None and len(_price_vector) == len(stocks_data):
+        shares = np.zeros(len(_price_vector))
+        for symbol, entry in portfolio.items():
+            i = _symbol_index.get(symbol)
+            if i is not None:
+                shares[i] = entry["shares"]
+        return float(shares @ _price_vector)
+
+    # Pure-Python fallback when numpy is missing or the vector is stale
+    return sum(
+        stocks_data[symbol]["current_price"] * entry["shares"]
+        for symbol, entry in portfolio.items()
+        if symbol in stocks_data and "current_price" in stocks_data[symbol]
+    )
+
+# Alpha Vantage free tier allows 5 API calls per minute
+MAX_CONCURRENT_FETCHES = 5
+RATE_LIMIT_WINDOW = 60  # seconds before a rate-limit slot frees up again
+
+# Module-level so slots scheduled for release in one update cycle still count
+# against the next: the 5-per-60 s budget spans tick boundaries
+_fetch_sem = asyncio.Semaphore(MAX_CONCURRENT_FETCHES)
+
+async def _fetch_limited(symbol: str) -> Optional[float]:
+    """Fetch a price while holding a rate-limit slot.
+
+    Each slot is released a full RATE_LIMIT_WINDOW after its request starts
+    (token-bucket style), so no more than MAX_CONCURRENT_FETCHES calls begin
+    in any 60 s window regardless of how fast responses come back. Refreshing
+    more than that many symbols simply spans multiple windows.
+    """
+    await _fetch_sem.acquire()
+    if time.time() < _rate_limited_until:
+        # A sibling fetch already hit the quota; don't waste a slot
+        _fetch_sem.release()
+        return None
+    asyncio.get_running_loop().call_later(RATE_LIMIT_WINDOW, _fetch_sem.release)
+    return await fetch_stock_price(symbol)
+
 # Task to update stock prices
 @tasks.loop(seconds=PRICE_UPDATE_INTERVAL)
 async def update_stock_prices():
     """Update prices for all tracked stocks"""
     if not stocks_data:
         return
-    
-    for symbol in list(stocks_data.keys()):
+
+    symbols = list(stocks_data.keys())
+
+    if time.time() < _rate_limited_until:
+        # Known to be rate-limited: fall straight through to mock prices
+        # instead of spending the cycle on doomed requests
+        results = [None] * len(symbols)
+    else:
+        # Fetch all symbols concurrently; the shared semaphore keeps us under
+        # the API rate limit without serializing the whole loop
+        results = await asyncio.gather(
+            *(_fetch_limited(symbol) for symbol in symbols),
+            return_exceptions=True
+        )
+
+    # One timestamp for the whole tick: every symbol's history point belongs
+    # to the same update, and it saves a datetime format per symbol
+    timestamp = datetime.datetime.now().isoformat()
+    today = timestamp[:10]
+
+    for symbol, price in zip(symbols, results):
         try:
-            # Use Alpha Vantage API with rate limiting
-            # Alpha Vantage free tier allows 5 API calls per minute
-            price = await fetch_stock_price(symbol)
-            
+            if isinstance(price, Exception):
+                logger.error(f"Error fetching price for {symbol}: {price}")
+                price = None
+
             # Fall back to mock data if Alpha Vantage fails or limits reached
             if price is None:
                 price = generate_mock_price(symbol)
                 logger.info(f"Using mock price for {symbol}: ${price}")
             else:
                 logger.info(f"Got real price for {symbol}: ${price}")
-            
-            # Record price history (keeping last 24 hours of data)
-            timestamp = datetime.datetime.now().isoformat()
-            if "history" not in stocks_data[symbol]:
-                stocks_data[symbol]["history"] = []
-            
-            stocks_data[symbol]["history"].append({"time": timestamp, "price": price})
-            # Keep only last 24 data points (e.g., last 24 hours if hourly updates)
-            if len(stocks_data[symbol]["history"]) > 24:
-                stocks_data[symbol]["history"] = stocks_data[symbol]["history"][-24:]
-            
-            # Update current price
-            old_price = stocks_data[symbol].get("current_price", price)
+
+            # Record price history; the bounded deque drops the oldest point
+            # in O(1) on append instead of re-slicing a list every tick
+            history = stocks_data[symbol].get("history")
+            if not isinstance(history, collections.deque):
+                history = collections.deque(history or [], maxlen=HISTORY_LIMIT)
+                stocks_data[symbol]["history"] = history
+
+            history.append({"time": timestamp, "price": price})
+
+            # Update current price; percent change is measured against the
+            # day's anchor (first price recorded today) so it reflects the
+            # daily move rather than the tick-to-tick jitter
+            if stocks_data[symbol].get("anchor_date") != today:
+                stocks_data[symbol]["anchor_price"] = price
+                stocks_data[symbol]["anchor_date"] = today
+
+            anchor_price = stocks_data[symbol]["anchor_price"]
             stocks_data[symbol]["current_price"] = price
-            stocks_data[symbol]["percent_change"] = ((price - old_price) / old_price) * 100 if old_price > 0 else 0
-            
-            # Add a delay to avoid hitting API rate limits
-            await asyncio.sleep(13)  # Sleep for 13 seconds to stay under 5 requests per minute
+            stocks_data[symbol]["percent_change"] = (price / anchor_price - 1) * 100 if anchor_price > 0 else 0
         except Exception as e:
             logger.error(f"Error updating price for {symbol}: {e}")
-    
-    save_data()
+
+    mark_stocks_dirty()
+    rebuild_price_vector()
+    bump_market_version()
 
 # Bot Events
+_ready_once = False
+
 @bot.event
 async def on_ready():
+    global _ready_once
+
     logger.info(f'{bot.user} has connected to Discord!')
-    load_data()
+
+    # on_ready fires again after reconnects; reloading from disk then would
+    # clobber in-memory state that the flush loop has not persisted yet, and
+    # the tasks.loops below are already running
+    if _ready_once:
+        return
+    _ready_once = True
+
+    await asyncio.to_thread(load_data)
     
     # Add default stocks if they don't exist
     for symbol in DEFAULT_STOCK_SYMBOLS:
@@ -189,7 +472,10 @@ async def on_ready():
                 
                 stocks_data[symbol] = {
                     "current_price": price,
-                    "history": [{"time": datetime.datetime.now().isoformat(), "price": price}],
+                    "history": collections.deque(
+                        [{"time": datetime.datetime.now().isoformat(), "price": price}],
+                        maxlen=HISTORY_LIMIT
+                    ),
                     "percent_change": 0.0
                 }
                 logger.info(f"Added default stock {symbol} at initial price ${price}")
@@ -197,15 +483,25 @@ async def on_ready():
                 logger.error(f"Failed to add default stock {symbol}: {e}")
     
     if DEFAULT_STOCK_SYMBOLS:
-        save_data()
-        
+        await save_data()
+
+    rebuild_price_vector()
     update_stock_prices.start()
+    flush_data.start()
+
+@bot.event
+async def on_disconnect():
+    # Force-flush any pending changes, then release the pooled connections;
+    # get_http_session() recreates the session lazily if the bot reconnects
+    if _users_dirty or _stocks_dirty:
+        await save_data()
+    await close_http_session()
 
 # Commands
 @bot.command(name='register', help='Register to play the stock market game')
 async def register(ctx):
-    user_id = str(ctx.author.id)
-    
+    user_id = ctx.author.id
+
     if user_id in users_data:
         await ctx.send(f"You're already registered, {ctx.author.name}!")
         return
@@ -216,30 +512,24 @@ async def register(ctx):
         "transactions": []
     }
     
-    save_data()
+    mark_users_dirty()
     await ctx.send(f"Welcome to the Stock Market Game, {ctx.author.name}! You've been given ${DEFAULT_STARTING_BALANCE:,.2f} to start.")
 
 @bot.command(name='balance', help='Check your current balance')
 async def balance(ctx):
-    user_id = str(ctx.author.id)
-    
-    if user_id not in users_data:
+    user = users_data.get(ctx.author.id)
+
+    if user is None:
         await ctx.send(f"You're not registered yet! Use `$register` to start playing.")
         return
-    
-    balance = users_data[user_id]["balance"]
-    
-    # Calculate portfolio value
-    portfolio_value = 0
-    for symbol, shares in users_data[user_id]["portfolio"].items():
-        if symbol in stocks_data and "current_price" in stocks_data[symbol]:
-            portfolio_value += stocks_data[symbol]["current_price"] * shares
-    
-    total_value = balance + portfolio_value
-    
+
+    balance = user["balance"]
+    holdings_value = portfolio_value(user["portfolio"])
+    total_value = balance + holdings_value
+
     embed = discord.Embed(title=f"{ctx.author.name}'s Financial Status", color=0x00ff00)
     embed.add_field(name="Cash Balance", value=f"${balance:,.2f}", inline=False)
-    embed.add_field(name="Portfolio Value", value=f"${portfolio_value:,.2f}", inline=False)
+    embed.add_field(name="Portfolio Value", value=f"${holdings_value:,.2f}", inline=False)
     embed.add_field(name="Total Net Worth", value=f"${total_value:,.2f}", inline=False)
     
     await ctx.send(embed=embed)
@@ -266,11 +556,16 @@ async def add_stock(ctx, symbol: str, price: float = None):
     
     stocks_data[symbol] = {
         "current_price": price,
-        "history": [{"time": datetime.datetime.now().isoformat(), "price": price}],
+        "history": collections.deque(
+            [{"time": datetime.datetime.now().isoformat(), "price": price}],
+            maxlen=HISTORY_LIMIT
+        ),
         "percent_change": 0.0
     }
-    
-    save_data()
+
+    mark_stocks_dirty()
+    rebuild_price_vector()
+    bump_market_version()
     await ctx.send(f"Added {symbol} to the market at ${price:,.2f}")
 
 @bot.command(name='price', help='Check the current price of a stock')
@@ -310,36 +605,39 @@ async def price(ctx, symbol: str):
 
 @bot.command(name='buy', help='Buy shares of a stock')
 async def buy(ctx, symbol: str, shares: int):
-    user_id = str(ctx.author.id)
     symbol = symbol.upper()
-    
-    # Validations
-    if user_id not in users_data:
+
+    # Validations; bind the records once instead of re-looking them up below
+    user = users_data.get(ctx.author.id)
+    if user is None:
         await ctx.send(f"You're not registered yet! Use `$register` to start playing.")
         return
-    
-    if symbol not in stocks_data:
+
+    stock = stocks_data.get(symbol)
+    if stock is None:
         await ctx.send(f"Stock {symbol} is not tracked. Ask an admin to add it.")
         return
-    
+
     if shares <= 0:
         await ctx.send("You must buy at least 1 share.")
         return
-    
-    price = stocks_data[symbol].get("current_price", 0)
+
+    price = stock.get("current_price", 0)
     total_cost = price * shares
-    
-    if users_data[user_id]["balance"] < total_cost:
-        await ctx.send(f"You don't have enough money! Cost: ${total_cost:,.2f}, Your balance: ${users_data[user_id]['balance']:,.2f}")
+
+    if user["balance"] < total_cost:
+        await ctx.send(f"You don't have enough money! Cost: ${total_cost:,.2f}, Your balance: ${user['balance']:,.2f}")
         return
-    
+
     # Process purchase
-    users_data[user_id]["balance"] -= total_cost
-    
-    if symbol not in users_data[user_id]["portfolio"]:
-        users_data[user_id]["portfolio"][symbol] = 0
-    
-    users_data[user_id]["portfolio"][symbol] += shares
+    user["balance"] -= total_cost
+
+    if symbol not in user["portfolio"]:
+        user["portfolio"][symbol] = {"shares": 0, "cost_basis": 0.0}
+
+    entry = user["portfolio"][symbol]
+    entry["shares"] += shares
+    entry["cost_basis"] += total_cost
     
     # Record transaction
     transaction = {
@@ -350,52 +648,57 @@ async def buy(ctx, symbol: str, shares: int):
         "total": total_cost,
         "timestamp": datetime.datetime.now().isoformat()
     }
-    users_data[user_id]["transactions"].append(transaction)
-    
-    save_data()
-    
+    user["transactions"].append(transaction)
+    _trim_transactions(user)
+
+    mark_users_dirty()
+
     embed = discord.Embed(title="Purchase Successful", color=0x00ff00)
     embed.add_field(name="Stock", value=symbol, inline=True)
     embed.add_field(name="Shares", value=str(shares), inline=True)
     embed.add_field(name="Price per Share", value=f"${price:,.2f}", inline=True)
     embed.add_field(name="Total Cost", value=f"${total_cost:,.2f}", inline=True)
-    embed.add_field(name="New Balance", value=f"${users_data[user_id]['balance']:,.2f}", inline=True)
+    embed.add_field(name="New Balance", value=f"${user['balance']:,.2f}", inline=True)
     
     await ctx.send(embed=embed)
 
 @bot.command(name='sell', help='Sell shares of a stock')
 async def sell(ctx, symbol: str, shares: int):
-    user_id = str(ctx.author.id)
     symbol = symbol.upper()
-    
-    # Validations
-    if user_id not in users_data:
+
+    # Validations; bind the records once instead of re-looking them up below
+    user = users_data.get(ctx.author.id)
+    if user is None:
         await ctx.send(f"You're not registered yet! Use `$register` to start playing.")
         return
-    
-    if symbol not in stocks_data:
+
+    stock = stocks_data.get(symbol)
+    if stock is None:
         await ctx.send(f"Stock {symbol} is not tracked.")
         return
-    
+
     if shares <= 0:
         await ctx.send("You must sell at least 1 share.")
         return
-    
-    if symbol not in users_data[user_id]["portfolio"] or users_data[user_id]["portfolio"][symbol] < shares:
-        owned = users_data[user_id]["portfolio"].get(symbol, 0)
+
+    entry = user["portfolio"].get(symbol)
+    if entry is None or entry["shares"] < shares:
+        owned = entry["shares"] if entry else 0
         await ctx.send(f"You don't have enough shares! You own {owned} shares of {symbol}.")
         return
-    
+
     # Process sale
-    price = stocks_data[symbol].get("current_price", 0)
+    price = stock.get("current_price", 0)
     total_value = price * shares
-    
-    users_data[user_id]["balance"] += total_value
-    users_data[user_id]["portfolio"][symbol] -= shares
-    
+
+    user["balance"] += total_value
+    # Retire a proportional slice of the cost basis with the sold shares
+    entry["cost_basis"] -= entry["cost_basis"] * (shares / entry["shares"])
+    entry["shares"] -= shares
+
     # Remove stock from portfolio if no shares left
-    if users_data[user_id]["portfolio"][symbol] == 0:
-        del users_data[user_id]["portfolio"][symbol]
+    if entry["shares"] == 0:
+        del user["portfolio"][symbol]
     
     # Record transaction
     transaction = {
@@ -406,28 +709,29 @@ async def sell(ctx, symbol: str, shares: int):
         "total": total_value,
         "timestamp": datetime.datetime.now().isoformat()
     }
-    users_data[user_id]["transactions"].append(transaction)
-    
-    save_data()
-    
+    user["transactions"].append(transaction)
+    _trim_transactions(user)
+
+    mark_users_dirty()
+
     embed = discord.Embed(title="Sale Successful", color=0x0000ff)
     embed.add_field(name="Stock", value=symbol, inline=True)
     embed.add_field(name="Shares", value=str(shares), inline=True)
     embed.add_field(name="Price per Share", value=f"${price:,.2f}", inline=True)
     embed.add_field(name="Total Value", value=f"${total_value:,.2f}", inline=True)
-    embed.add_field(name="New Balance", value=f"${users_data[user_id]['balance']:,.2f}", inline=True)
+    embed.add_field(name="New Balance", value=f"${user['balance']:,.2f}", inline=True)
     
     await ctx.send(embed=embed)
 
 @bot.command(name='portfolio', help='View your stock portfolio')
 async def portfolio(ctx):
-    user_id = str(ctx.author.id)
-    
-    if user_id not in users_data:
+    user = users_data.get(ctx.author.id)
+
+    if user is None:
         await ctx.send(f"You're not registered yet! Use `$register` to start playing.")
         return
-    
-    portfolio = users_data[user_id]["portfolio"]
+
+    portfolio = user["portfolio"]
     
     if not portfolio:
         await ctx.send(f"You don't own any stocks yet. Use `$buy` to purchase some!")
@@ -436,20 +740,15 @@ async def portfolio(ctx):
     embed = discord.Embed(title=f"{ctx.author.name}'s Portfolio", color=0x00ffff)
     
     total_value = 0
-    for symbol, shares in portfolio.items():
+    for symbol, entry in portfolio.items():
         if symbol in stocks_data and "current_price" in stocks_data[symbol]:
             price = stocks_data[symbol]["current_price"]
+            shares = entry["shares"]
             value = price * shares
             total_value += value
-            
-            # Calculate profit/loss if we have transaction history
-            cost_basis = 0
-            for transaction in users_data[user_id]["transactions"]:
-                if transaction["symbol"] == symbol and transaction["type"] == "buy":
-                    cost_basis += transaction["total"]
-                elif transaction["symbol"] == symbol and transaction["type"] == "sell":
-                    cost_basis -= transaction["total"]
-            
+
+            # Profit/loss against the incrementally maintained cost basis
+            cost_basis = entry["cost_basis"]
             profit_loss = value - cost_basis
             pl_percent = (profit_loss / cost_basis) * 100 if cost_basis > 0 else 0
             
@@ -463,80 +762,113 @@ async def portfolio(ctx):
     
     await ctx.send(embed=embed)
 
+# Performance emoji per percent-change bucket: crash, down, flat, up, rocket.
+# One bisect against the breakpoints replaces a chain of comparisons per row.
+_EMOJI_BREAKPOINTS = (-2, 0, 0.0001, 2)
+_EMOJI = ("💥", "📉", "➡️", "📈", "🚀")
+
+# Rendered $market embed, reused until the next price tick (or add_stock)
+# bumps the market version and invalidates it
+_market_version = 0
+_market_embed: Optional[discord.Embed] = None
+_market_embed_version = -1
+
+def bump_market_version():
+    global _market_version
+    _market_version += 1
+
 @bot.command(name='market', help='See all available stocks')
 async def market(ctx):
+    global _market_embed, _market_embed_version
+
     if not stocks_data:
         await ctx.send("No stocks are currently tracked in the market.")
         return
-    
-    embed = discord.Embed(title="Stock Market", color=0xffff00)
-    
-    for symbol, data in stocks_data.items():
-        price = data.get("current_price", 0)
-        change = data.get("percent_change", 0)
-        
-        # Add emoji based on performance
-        if change > 2:
-            emoji = "🚀"  # Rocket for big gains
-        elif change > 0:
-            emoji = "📈"  # Chart up
-        elif change < -2:
-            emoji = "💥"  # Crash
-        elif change < 0:
-            emoji = "📉"  # Chart down
-        else:
-            emoji = "➡️"  # Sideways
-        
-        embed.add_field(
-            name=f"{symbol} {emoji}",
-            value=f"${price:,.2f} ({change:+.2f}%)",
-            inline=True
-        )
-    
-    await ctx.send(embed=embed)
+
+    if _market_embed is None or _market_embed_version != _market_version:
+        embed = discord.Embed(title="Stock Market", color=0xffff00)
+
+        for symbol, data in stocks_data.items():
+            price = data.get("current_price", 0)
+            change = data.get("percent_change", 0)
+
+            # Add emoji based on performance
+            emoji = _EMOJI[bisect.bisect(_EMOJI_BREAKPOINTS, change)]
+
+            embed.add_field(
+                name=f"{symbol} {emoji}",
+                value=f"${price:,.2f} ({change:+.2f}%)",
+                inline=True
+            )
+
+        _market_embed = embed
+        _market_embed_version = _market_version
+
+    await ctx.send(embed=_market_embed)
+
+USERNAME_CACHE_TTL = 300  # seconds
+
+# user_id -> (fetched_at, username); spares repeat leaderboards the HTTP hop
+_username_cache = {}
+
+async def _get_username(user_id) -> str:
+    """Resolve a username via Discord, caching results for a few minutes"""
+    cached = _username_cache.get(user_id)
+    if cached and time.time() - cached[0] < USERNAME_CACHE_TTL:
+        return cached[1]
+
+    try:
+        user = await bot.fetch_user(int(user_id))
+        username = user.name
+    except:
+        username = f"User {user_id}"
+
+    _username_cache[user_id] = (time.time(), username)
+    return username
+
+LEADERBOARD_CACHE_TTL = 30  # seconds
+
+_leaderboard_embed: Optional[discord.Embed] = None
+_leaderboard_cached_at = 0.0
 
 @bot.command(name='leaderboard', help='Show the richest players')
 async def leaderboard(ctx):
+    global _leaderboard_embed, _leaderboard_cached_at
+
     if not users_data:
         await ctx.send("No players have registered yet!")
         return
-    
-    # Calculate net worth for each user
-    net_worths = []
-    for user_id, data in users_data.items():
-        balance = data["balance"]
-        portfolio_value = 0
-        
-        for symbol, shares in data["portfolio"].items():
-            if symbol in stocks_data and "current_price" in stocks_data[symbol]:
-                portfolio_value += stocks_data[symbol]["current_price"] * shares
-        
-        net_worth = balance + portfolio_value
-        
-        try:
-            user = await bot.fetch_user(int(user_id))
-            username = user.name
-        except:
-            username = f"User {user_id}"
-        
-        net_worths.append({
-            "username": username,
-            "net_worth": net_worth
-        })
-    
+
+    # The standings barely move between price ticks; reuse a recent render
+    if _leaderboard_embed is not None and time.time() - _leaderboard_cached_at < LEADERBOARD_CACHE_TTL:
+        await ctx.send(embed=_leaderboard_embed)
+        return
+
+    # Net worth pass is pure dict/array math over the shared price vector
+    net_worths = [
+        (user_id, data["balance"] + portfolio_value(data["portfolio"]))
+        for user_id, data in users_data.items()
+    ]
+
     # Sort by net worth (descending)
-    net_worths.sort(key=lambda x: x["net_worth"], reverse=True)
-    
+    net_worths.sort(key=lambda x: x[1], reverse=True)
+    top = net_worths[:10]
+
+    # Only the displayed rows need usernames; resolve them concurrently
+    usernames = await asyncio.gather(*(_get_username(user_id) for user_id, _ in top))
+
     embed = discord.Embed(title="Stock Market Game Leaderboard", color=0xffd700)
-    
-    # Display top 10
-    for i, entry in enumerate(net_worths[:10], 1):
+
+    for i, ((user_id, net_worth), username) in enumerate(zip(top, usernames), 1):
         embed.add_field(
-            name=f"{i}. {entry['username']}",
-            value=f"${entry['net_worth']:,.2f}",
+            name=f"{i}. {username}",
+            value=f"${net_worth:,.2f}",
             inline=False
         )
-    
+
+    _leaderboard_embed = embed
+    _leaderboard_cached_at = time.time()
+
     await ctx.send(embed=embed)
 
 @bot.command(name='help_stocks', help='Display help for stock market commands')
@@ -620,7 +952,16 @@ def main():
     if not TOKEN:
         print("Error: DISCORD_TOKEN is not set in environment variables.")
         return
-    bot.run(TOKEN)
+    try:
+        bot.run(TOKEN)
+    finally:
+        # Shutdown can cancel the async flush mid-await (Ctrl-C/SIGTERM tears
+        # down pending tasks), so persist any remaining dirty state
+        # synchronously before the process exits
+        if _users_dirty:
+            _save_users_sync()
+        if _stocks_dirty:
+            _save_stocks_sync()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file